@@ -1,15 +1,31 @@
 import dash
 import base64
 import io
+import os
+import tempfile
+import uuid
 import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
 from dash import dcc, html, Input, Output, State
 from dash.exceptions import PreventUpdate
+from flask_caching import Cache
+from tsdownsample import LTTBDownsampler
 
 from outlook_parser import CSVMailReader, PSTMailReader
 
+MAX_PLOT_POINTS = 2000
+DECODE_CHUNK_SIZE = 64 * 1024
+
 app = dash.Dash(__name__)
 
+cache = Cache(app.server, config={
+    'CACHE_TYPE': 'FileSystemCache',
+    'CACHE_DIR': '/tmp/dashcache',
+    'CACHE_DEFAULT_TIMEOUT': 24 * 60 * 60,
+    'CACHE_THRESHOLD': 200
+})
+
 app.layout = html.Div([
     html.H1("Mail Reader Web Interface - PGR"),
 
@@ -51,6 +67,8 @@ app.layout = html.Div([
             clearable=False
         ),
 
+        html.Div(id='graphs-status'),
+
         dcc.Graph(id='time-series-graph'),
 
         dcc.Graph(id='average-emails-graph'),
@@ -74,6 +92,20 @@ def parse_contents(contents, filename):
 
     return df
 
+def decode_to_tempfile(content_string, suffix='.pst'):
+    """Decodes a base64 string into a temporary file chunk by chunk and returns its path"""
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp:
+        try:
+            # The chunk size is a multiple of 4 so every chunk is a whole base64 block
+            for i in range(0, len(content_string), DECODE_CHUNK_SIZE):
+                tmp.write(base64.b64decode(content_string[i:i + DECODE_CHUNK_SIZE]))
+        except Exception:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+
+    return tmp.name
+
 @app.callback(
     Output('file-upload-status', 'children'),
     Output('stored-data', 'data'),
@@ -86,78 +118,79 @@ def update_output(file_contents, filename):
 
     try:
         content_type, content_string = file_contents.split(",")
-        decoded = base64.b64decode(content_string)
-        file = io.BytesIO(decoded)
-
-        mail_reader = PSTMailReader(file)
-
-        df = mail_reader.df
-        
-        df_json = mail_reader.df.to_json(date_format='iso', orient='split')
+        pst_path = decode_to_tempfile(content_string)
+
+        try:
+            mail_reader = PSTMailReader(pst_path)
+        finally:
+            os.remove(pst_path)
+
+        session_key = str(uuid.uuid4())
+        cache.set(session_key, {
+            'rollups': mail_reader.rollups,
+            'averages': mail_reader.averages,
+            'after_hours': mail_reader.after_hours
+        })
 
-        return f'File "{filename}" uploaded successfully!', df_json
+        return f'File "{filename}" uploaded successfully!', session_key
 
     except Exception as e:
         return f'File {filename} failed to upload: {e}', None
 
+def downsample(df, n_out=MAX_PLOT_POINTS):
+    """Reduces the rows of a Date/Count frame to n_out points keeping its visual shape (LTTB)"""
+    if len(df) <= n_out:
+        return df
+
+    x = df["Date"].values.view('i8')
+    y = df["Count"].values
+    indices = LTTBDownsampler().downsample(x, y, n_out=n_out)
+
+    return df.iloc[indices]
+
 @app.callback(
     Output('time-series-graph', 'figure'),
     Output('average-emails-graph', 'figure'),
     Output('after-hours-emails-graph', 'figure'),
+    Output('graphs-status', 'children'),
     Input('stored-data', 'data'),
     Input('time-period', 'value')
 )
-def update_graphs(data, time_period):
-    if data is None:
+def update_graphs(session_key, time_period):
+    if session_key is None:
         raise PreventUpdate
 
-    df = pd.read_json(data, orient='split')
+    aggregates = cache.get(session_key)
+    if aggregates is None:
+        return dash.no_update, dash.no_update, dash.no_update, \
+            'The uploaded data has expired. Please upload the PST file again.'
 
-    df["Date"] = pd.to_datetime(df["Date"], errors='coerce')
-    df = df.dropna(subset=["Date"])
-
-    df_grouped = df.set_index("Date").resample(time_period).size().reset_index(name="Count")
-    df_grouped["Date"] = pd.to_datetime(df_grouped["Date"])
+    df_grouped = aggregates['rollups'][time_period]
+    df_avg = aggregates['averages'][time_period]
+    df_after_hours_grouped = aggregates['after_hours']
 
     max_count = df_grouped["Count"].max()
     yaxis_upper_limit = max(max_count + 10, max(20, min(100, max_count * 1.2)))
 
     period_label = {"M": "Month", "W": "Week", "D": "Day"}[time_period]
 
-    fig_emails = px.line(df_grouped, x='Date', y='Count', title=f'Emails Received Per {period_label}')
+    df_plot = downsample(df_grouped)
+
+    fig_emails = go.Figure(go.Scattergl(x=df_plot["Date"], y=df_plot["Count"], mode='lines'))
+    fig_emails.update_layout(title=f'Emails Received Per {period_label}',
+                             xaxis_title='Date', yaxis_title='Count')
     fig_emails.update_yaxes(range=[0, yaxis_upper_limit]) 
 
     if time_period == 'M':
-        avg_count = df_grouped["Count"].mean()
-
-        df_avg = pd.DataFrame({
-            'Interval': [period_label],
-            'Average Count': [avg_count]
-        })
-
         fig_avg = px.bar(df_avg, x='Interval', y='Average Count', title=f'Average Emails Received Per {period_label}')
-        fig_avg.update_yaxes(range=[0, yaxis_upper_limit])
-
     else:
-        df_grouped['Month'] = df_grouped['Date'].dt.to_period('M').astype(str)
-
-        df_avg = df_grouped.groupby('Month')['Count'].mean().reset_index()
-
-        fig_avg = px.bar(df_avg, x='Month', y='Count', title=f'Average Emails Received Per {period_label} in each Month')
-        fig_avg.update_yaxes(range=[0, yaxis_upper_limit])
-
-    after_hours_time = pd.to_datetime("13:30").time()
-    print(df["Date"])
-    print(df["Date"].dt.time)
-
-    df_after_hours = df[df["Date"].dt.time > after_hours_time]
-    df_after_hours_grouped = df_after_hours.resample('D', on="Date").size().reset_index(name="Count")
+        fig_avg = px.bar(df_avg, x='Date', y='Count', title=f'Average Emails Received Per {period_label} in each Month')
+    fig_avg.update_yaxes(range=[0, yaxis_upper_limit])
 
     fig_after_hours = px.bar(df_after_hours_grouped, x='Date', y='Count', title='Emails Received After 13:30 Per Day')
     fig_after_hours.update_yaxes(range=[0, df_after_hours_grouped["Count"].max() + 5])
 
-    return fig_emails, fig_avg, fig_after_hours
-
+    return fig_emails, fig_avg, fig_after_hours, None
 
 if __name__ == '__main__':
     app.run_server(debug=True)
@@ -1,10 +1,25 @@
 """Module that reads a csv file containing Outlook emails extracted info"""
 import os
+import re
 import argparse
+from collections import Counter
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property, partial
+import numpy as np
 import pandas as pd
 from io import StringIO, BytesIO
 from aspose.email.storage.pst import PersonalStorage
 
+TEAMS_SUFFIX_PATTERN = re.compile(r'^\s*(.*?)\s+(?:en|in|auf|sur|su)\s+teams\s*$', re.IGNORECASE)
+
+TIME_PERIODS = ('M', 'W', 'D')
+NS_PER_MINUTE = 60_000_000_000
+NS_PER_DAY = 86_400_000_000_000
+AFTER_HOURS_MINUTE = 13 * 60 + 30
+PST_PAGE_SIZE = 500
+PARALLEL_EXTRACTION_THRESHOLD = 2000
+
 class PSTMailReader:
     """This class parses an extracted outlook mails pst file and provides tools to work around it"""
     def __init__(self, file=None, unwanted_file: str = 'data/unwanted.csv') -> None:
@@ -14,6 +29,11 @@ class PSTMailReader:
         
         self.df = self.__load_pst()
 
+        self.rollups = {period: self.df.set_index('Date').resample(period).size().reset_index(name='Count')
+                        for period in TIME_PERIODS}
+        self.averages = self.__average_rollups()
+        self.after_hours = self.__count_after_hours()
+
     def __load_unwanted_list(self) -> list:
         """Loads the unwanted senders list from the unwanted file"""
         if os.path.exists(self.unwanted_file):
@@ -22,48 +42,110 @@ class PSTMailReader:
         else:
             return []
 
+    def __average_rollups(self) -> dict:
+        """Averages the monthly counts overall, and the weekly and daily counts in each month"""
+        averages = {'M': pd.DataFrame({
+            'Interval': ['Month'],
+            'Average Count': [self.rollups['M']['Count'].mean()]
+        })}
+        for period in ('W', 'D'):
+            averages[period] = self.rollups[period].set_index('Date')['Count'].resample('MS').mean().reset_index()
+        return averages
+
+    def __count_after_hours(self) -> pd.DataFrame:
+        """Counts the mails received after hours on each day"""
+        ns = self.df['Date'].to_numpy(dtype='datetime64[ns]').view('i8')
+        after_hours = (ns % NS_PER_DAY) > AFTER_HOURS_MINUTE * NS_PER_MINUTE
+
+        after_hours_days = ns[after_hours] // NS_PER_DAY
+        if len(after_hours_days):
+            first_day = after_hours_days.min()
+            counts = np.bincount(after_hours_days - first_day)
+            dates = pd.date_range(pd.Timestamp(first_day * NS_PER_DAY), periods=len(counts), freq='D')
+        else:
+            counts = np.array([], dtype='i8')
+            dates = pd.DatetimeIndex([])
+
+        return pd.DataFrame({'Date': dates, 'Count': counts})
+
+    def __open_pst(self) -> PersonalStorage:
+        """Opens the PST file or stream as a new read-only store"""
+        if isinstance(self.file, BytesIO):
+            return PersonalStorage.from_stream(self.file)
+        return PersonalStorage.from_file(self.file, False)
+
+    def __extract_columns(self, pst, entry_ids, unwanted) -> tuple:
+        """Extracts the senders, subjects and dates of the messages as column lists, skipping unwanted senders"""
+        senders, subjects, dates = [], [], []
+        for entry_id in entry_ids:
+            mapi = pst.extract_message(entry_id)
+            if mapi.sender_name in unwanted:
+                continue
+            senders.append(mapi.sender_name)
+            subjects.append(mapi.subject)
+            dates.append(mapi.delivery_time)
+        return senders, subjects, dates
+
+    def __extract_batch(self, entry_ids, unwanted) -> tuple:
+        """Extracts a batch of messages through a store of its own, so no worker shares a file handle"""
+        with self.__open_pst() as pst:
+            return self.__extract_columns(pst, entry_ids, unwanted)
+
     def __load_pst(self) -> pd.DataFrame:
         """Carga los datos desde un archivo PST y devuelve un DataFrame de pandas"""
         if not self.file:
             raise ValueError("No PST file provided")
 
         try:
-            if isinstance(self.file, BytesIO):
-                pst = PersonalStorage.from_stream(self.file)
-            else:
-                pst = PersonalStorage.from_file(self.file)
+            pst = self.__open_pst()
+        except Exception as e:
+            print(f'Error trying to load the pst file: {e}')
+            return pd.DataFrame({
+                'Sender': pd.Series(dtype=object),
+                'Subject': pd.Series(dtype=object),
+                'Date': pd.Series(dtype='datetime64[ns]')
+            })
+
+        unwanted = frozenset(self.unwanted_list)
 
+        with pst:
             count = pst.store.get_total_items_count()
             folder_info = pst.root_folder.get_sub_folder("Bandeja de entrada")
 
-            data = []
-
-            for j in range(0, count, 50):
+            # MessageInfo only exposes the name the mail was sent on behalf of, so a mail that a
+            # wanted sender delegated from an unwanted principal is skipped here as well
+            entry_ids = []
+            for j in range(0, count, PST_PAGE_SIZE):
                 print(j)
-                message_info_collection = folder_info.get_contents(j,50)
-                for message_info in message_info_collection:
-                    mapi = pst.extract_message(message_info)
-
-                    sender = mapi.sender_name
-                    subject = mapi.subject
-                    date = mapi.delivery_time
-
-                    if sender in self.unwanted_list:
-                        continue
-
-                    data.append({
-                        'Sender': sender,
-                        'Subject': subject,
-                        'Date': date
-                    })
-
-            data = sorted(data, key=lambda x: x['Date'], reverse=True)
-
-            return pd.DataFrame(data)    
-
-        except Exception as e:
-            print(f'Error trying to load the pst file: {e}')
-            return pd.DataFrame()
+                entry_ids.extend(message_info.entry_id
+                                 for message_info in folder_info.get_contents(j, PST_PAGE_SIZE)
+                                 if message_info.sender_representative_name not in unwanted)
+
+            # A stream can only back one store, and small inboxes are not worth opening more
+            parallel = not isinstance(self.file, BytesIO) and len(entry_ids) >= PARALLEL_EXTRACTION_THRESHOLD
+            if not parallel:
+                senders, subjects, dates = self.__extract_columns(pst, entry_ids, unwanted)
+
+        if parallel:
+            workers = min(os.cpu_count() or 1, len(entry_ids))
+            batch_size = -(-len(entry_ids) // workers)
+            batches = [entry_ids[i:i + batch_size] for i in range(0, len(entry_ids), batch_size)]
+            senders, subjects, dates = [], [], []
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                extract_batch = partial(self.__extract_batch, unwanted=unwanted)
+                for batch_senders, batch_subjects, batch_dates in executor.map(extract_batch, batches):
+                    senders.extend(batch_senders)
+                    subjects.extend(batch_subjects)
+                    dates.extend(batch_dates)
+
+        df = pd.DataFrame({
+            'Sender': senders,
+            'Subject': subjects,
+            'Date': pd.to_datetime(dates, errors='coerce')
+        })
+        df = df.dropna(subset=['Date'])
+
+        return df.sort_values('Date', ascending=False, ignore_index=True)
 
 class CSVMailReader:
     """This class parses an extracted outlook mails csv file and provides tools to work around it"""
@@ -106,32 +188,44 @@ class CSVMailReader:
 
     def normalize_senders(self):
         """Normalize senders by removing phrases like 'en teams' in multiple languages"""
-        teams_variants = ['en teams', 'in teams', 'auf teams', 'sur teams', 'su teams']
-
-        def normalize_name(sender):
-            for variant in teams_variants:
-                if sender.lower().endswith(variant):
-                    return sender[:-(len(variant) + 1)].strip()
-            return sender
-
-        self.df['De: (nombre)'] = self.df['De: (nombre)'].apply(normalize_name)
+        # Only names with a Teams suffix are rewritten (and stripped), the rest are kept as they are
+        self.df['De: (nombre)'] = self.df['De: (nombre)'].str.replace(
+            TEAMS_SUFFIX_PATTERN, r'\1', regex=True)
         self.update_senders()
 
     def update_senders(self):
-        """Updates the senders' names and counts"""
-        self.senders_df = self.df['De: (nombre)'].value_counts().reset_index()
-        self.senders_df.columns = ['Sender', 'Count']
+        """Recounts the senders' names from the dataframe"""
+        self._counts = Counter(self.df['De: (nombre)'].dropna())
+        self.__reset_senders_df()
+
+    def __reset_senders_df(self) -> None:
+        """Drops the cached senders_df so it is rebuilt from the counts on next access"""
+        self.__dict__.pop('senders_df', None)
+
+    @cached_property
+    def senders_df(self) -> pd.DataFrame:
+        """The senders and their counts, most frequent first"""
+        return pd.DataFrame.from_records(self._counts.most_common(), columns=['Sender', 'Count'])
 
     def print_senders(self) -> None:
         """Prints the senders and the count of how many times they appear"""
         print("List of senders and their counts:")
-        for idx, row in self.senders_df.iterrows():
-            print(f"{idx + 1}. {row['Sender']} ({row['Count']} times)")
+        for idx, (sender, count) in enumerate(self.senders_df.itertuples(index=False), 1):
+            print(f"{idx}. {sender} ({count} times)")
+
+    def remove_senders(self, sender_names: Iterable[str]) -> None:
+        """Removes all the given senders from the dataframe in a single pass"""
+        if isinstance(sender_names, str):
+            raise TypeError("sender_names must be an iterable of names, not a single name")
+        sender_names = list(sender_names)
+        self.df = self.df[~self.df['De: (nombre)'].isin(sender_names)]
+        for sender_name in sender_names:
+            del self._counts[sender_name]
+        self.__reset_senders_df()
 
     def remove_sender(self, sender_name: str) -> None:
         """Removes the sender from the dataframe"""
-        self.df = self.df[self.df['De: (nombre)'] != sender_name]
-        self.update_senders()
+        self.remove_senders([sender_name])
         print(f"Sender '{sender_name}' has been removed.")
 
     def remove_sender_interactive(self, sender_idx: int) -> None:
@@ -154,9 +248,7 @@ class CSVMailReader:
 
     def load_unwanted_list(self) -> None:
         """Removes all senders from the unwanted list"""
-        for sender in self.unwanted_list:
-            if sender in self.senders_df['Sender'].values:
-                self.remove_sender(sender)
+        self.remove_senders(self.unwanted_list)
         print("Unwanted senders removed from the dataset.")
 
     def export_changes(self, output_file: str = None) -> None: